@@ -0,0 +1,349 @@
+"""In-memory index of reference face embeddings for all registered users.
+
+Embeddings are L2-normalized and kept as rows of one float32 matrix, so cosine
+similarity against every registered candidate is a single matrix multiply.
+The index is persisted as a .npy matrix plus a JSON manifest naming that
+matrix file, its row count and the user IDs; loading memory-maps the matrix,
+so worker processes start without reading it all in. SharedEmbeddingIndex
+keeps several API/worker processes in step on one index directory.
+"""
+import os
+import json
+import fcntl
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Tuple, Optional
+
+import numpy as np
+
+logger = logging.getLogger("anti_cheat_embedding_index")
+
+MANIFEST_FILENAME = "user_ids.json"
+INITIAL_CAPACITY = 64
+# Superseded matrix files are kept this long for processes mid-load
+STALE_MATRIX_SECONDS = 600
+
+
+def normalize_embeddings(embeddings) -> np.ndarray:
+    """L2-normalize a (d,) or (n, d) array of embeddings row-wise"""
+    embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+class EmbeddingIndex:
+    """Normalized reference embeddings keyed by user ID, with top-k cosine search"""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._matrix = np.zeros((INITIAL_CAPACITY, dim), dtype=np.float32)
+        self._user_ids: List[str] = []
+        self._rows = {}
+
+    def __len__(self) -> int:
+        return len(self._user_ids)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._rows
+
+    @property
+    def user_ids(self) -> List[str]:
+        return list(self._user_ids)
+
+    def _ensure_writable(self, rows: int):
+        # Grow geometrically; this also swaps a memory-mapped matrix for an
+        # in-memory copy the first time the index is modified after load()
+        capacity = self._matrix.shape[0]
+        if rows <= capacity and self._matrix.flags.writeable:
+            return
+        new_capacity = max(INITIAL_CAPACITY, capacity)
+        while new_capacity < rows:
+            new_capacity *= 2
+        matrix = np.zeros((new_capacity, self.dim), dtype=np.float32)
+        matrix[:len(self)] = self._matrix[:len(self)]
+        self._matrix = matrix
+
+    def add(self, user_id: str, embedding) -> None:
+        """Add or replace the reference embedding for a user"""
+        vector = normalize_embeddings(embedding)
+        if vector.shape != (1, self.dim):
+            raise ValueError(f"Expected embedding of size {self.dim}, got {vector.shape[1]}")
+
+        row = self._rows.get(user_id)
+        if row is None:
+            row = len(self)
+            self._ensure_writable(row + 1)
+            self._rows[user_id] = row
+            self._user_ids.append(user_id)
+        else:
+            self._ensure_writable(len(self))
+        self._matrix[row] = vector[0]
+
+    def remove(self, user_id: str) -> bool:
+        """Remove a user's embedding; returns False if the user was not indexed"""
+        row = self._rows.pop(user_id, None)
+        if row is None:
+            return False
+
+        self._ensure_writable(len(self))
+        last = len(self) - 1
+        if row != last:
+            # Move the last row into the gap so live rows stay contiguous
+            moved_user_id = self._user_ids[last]
+            self._matrix[row] = self._matrix[last]
+            self._user_ids[row] = moved_user_id
+            self._rows[moved_user_id] = row
+        self._user_ids.pop()
+        return True
+
+    def score(self, user_id: str, embedding) -> Optional[float]:
+        """Cosine similarity between an embedding and a user's reference, or None if not indexed"""
+        row = self._rows.get(user_id)
+        if row is None:
+            return None
+        vector = normalize_embeddings(embedding)[0]
+        return float(self._matrix[row] @ vector)
+
+    def search(self, embeddings, k: int = 1) -> List[List[Tuple[str, float]]]:
+        """Top-k (user_id, cosine similarity) matches for each query embedding, best first"""
+        queries = normalize_embeddings(embeddings)
+        if queries.shape[1] != self.dim:
+            raise ValueError(f"Expected embeddings of size {self.dim}, got {queries.shape[1]}")
+        if len(self) == 0 or k <= 0:
+            return [[] for _ in range(queries.shape[0])]
+
+        similarities = queries @ self._matrix[:len(self)].T
+        k = min(k, len(self))
+        if k < len(self):
+            top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(len(self)), (queries.shape[0], len(self)))
+        top_scores = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        return [
+            [(self._user_ids[i], float(score)) for i, score in zip(rows, scores)]
+            for rows, scores in zip(top.tolist(), top_scores.tolist())
+        ]
+
+    def save(self, directory: str) -> None:
+        """Write the index to a directory.
+
+        Each save writes the matrix under a new file name and then atomically
+        replaces the manifest that points at it, so a crash mid-save leaves
+        the previous index intact. Superseded matrices are only deleted once
+        they are older than STALE_MATRIX_SECONDS, so a process that read the
+        previous manifest can still open the matrix it names.
+        """
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+
+        matrix_filename = f"embeddings-{uuid.uuid4().hex}.npy"
+        with open(os.path.join(directory, matrix_filename), "wb") as f:
+            np.save(f, np.ascontiguousarray(self._matrix[:len(self)]))
+            f.flush()
+            os.fsync(f.fileno())
+
+        manifest = {
+            "matrix": matrix_filename,
+            "rows": len(self),
+            "dim": self.dim,
+            "user_ids": self._user_ids,
+        }
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+        _remove_stale_matrices(directory, keep=matrix_filename)
+
+    @classmethod
+    def load(cls, directory: str, dim: int) -> "EmbeddingIndex":
+        """Load a saved index, memory-mapping the embedding matrix read-only.
+
+        Raises FileNotFoundError if the manifest or its matrix is missing, and
+        ValueError if either fails to parse or validate.
+        """
+        manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+        manifest = _read_manifest(manifest_path)
+        try:
+            matrix = np.load(os.path.join(directory, manifest["matrix"]), mmap_mode="r")
+        except FileNotFoundError:
+            # A concurrent save may have replaced the manifest we read; retry once
+            manifest = _read_manifest(manifest_path)
+            matrix = np.load(os.path.join(directory, manifest["matrix"]), mmap_mode="r")
+        user_ids = manifest["user_ids"]
+
+        if matrix.ndim != 2 or matrix.shape[1] != dim or matrix.dtype != np.float32:
+            raise ValueError(f"Embedding matrix has shape {matrix.shape} and dtype {matrix.dtype}")
+        if not isinstance(user_ids, list) or not (matrix.shape[0] == manifest["rows"] == len(user_ids)):
+            raise ValueError(
+                f"{matrix.shape[0]} embeddings, manifest records {manifest['rows']} rows "
+                f"and {len(user_ids)} user IDs"
+            )
+        if len(set(user_ids)) != len(user_ids):
+            raise ValueError("Duplicate user IDs in manifest")
+
+        index = cls(dim)
+        index._matrix = matrix
+        index._user_ids = list(user_ids)
+        index._rows = {user_id: row for row, user_id in enumerate(user_ids)}
+        return index
+
+    @classmethod
+    def load_or_create(cls, directory: str, dim: int) -> "EmbeddingIndex":
+        """Load the index from directory, or start an empty one if there is none.
+
+        A manifest that fails to parse or validate is moved aside rather than
+        left for the next save() to overwrite, so the data can be recovered.
+        Missing files and other I/O errors are raised, never treated as
+        corruption.
+        """
+        if not os.path.exists(os.path.join(directory, MANIFEST_FILENAME)):
+            return cls(dim)
+        try:
+            index = cls.load(directory, dim)
+        except (ValueError, TypeError) as e:
+            with _directory_lock(directory):
+                return cls._recover(directory, dim, e)
+        logger.info(f"Loaded {len(index)} reference embeddings from {directory}")
+        return index
+
+    @classmethod
+    def _recover(cls, directory: str, dim: int, error: Exception) -> "EmbeddingIndex":
+        # Must hold the directory lock: re-check, since another process may
+        # have rewritten the manifest since the failed load
+        try:
+            return cls.load(directory, dim)
+        except FileNotFoundError:
+            if not os.path.exists(os.path.join(directory, MANIFEST_FILENAME)):
+                return cls(dim)
+            raise
+        except (ValueError, TypeError) as e:
+            error = e
+
+        manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+        corrupt_path = f"{manifest_path}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        os.replace(manifest_path, corrupt_path)
+        logger.error(
+            f"Failed to load embedding index from {directory}: {str(error)}; "
+            f"moved manifest to {corrupt_path} and starting with an empty index"
+        )
+        return cls(dim)
+
+
+class SharedEmbeddingIndex:
+    """EmbeddingIndex backed by a directory that several processes share.
+
+    Reads reload the index whenever the manifest on disk has changed. Writes
+    take an exclusive lock on the directory, apply the change to a fresh copy
+    of the on-disk index and save it, so concurrent writers never drop each
+    other's registrations.
+    """
+
+    def __init__(self, directory: str, dim: int):
+        self.directory = directory
+        self.dim = dim
+        self._index = EmbeddingIndex.load_or_create(directory, dim)
+        self._signature = self._manifest_signature()
+
+    def _manifest_signature(self):
+        try:
+            stat = os.stat(os.path.join(self.directory, MANIFEST_FILENAME))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def refresh(self) -> None:
+        """Reload the index if another process has saved a new version"""
+        signature = self._manifest_signature()
+        if signature == self._signature:
+            return
+        try:
+            self._index = (
+                EmbeddingIndex.load(self.directory, self.dim) if signature else EmbeddingIndex(self.dim)
+            )
+            self._signature = signature
+        except Exception as e:
+            logger.warning(f"Keeping previous embedding index; reload failed: {str(e)}")
+
+    def _update(self, change):
+        with _directory_lock(self.directory):
+            if os.path.exists(os.path.join(self.directory, MANIFEST_FILENAME)):
+                try:
+                    index = EmbeddingIndex.load(self.directory, self.dim)
+                except (ValueError, TypeError) as e:
+                    index = EmbeddingIndex._recover(self.directory, self.dim, e)
+            else:
+                index = EmbeddingIndex(self.dim)
+            result = change(index)
+            index.save(self.directory)
+            self._index = index
+            self._signature = self._manifest_signature()
+        return result
+
+    def add(self, user_id: str, embedding) -> None:
+        """Add or replace a user's reference embedding and persist it"""
+        self._update(lambda index: index.add(user_id, embedding))
+
+    def remove(self, user_id: str) -> bool:
+        """Remove a user's embedding and persist the change"""
+        return self._update(lambda index: index.remove(user_id))
+
+    def score(self, user_id: str, embedding) -> Optional[float]:
+        self.refresh()
+        return self._index.score(user_id, embedding)
+
+    def search(self, embeddings, k: int = 1) -> List[List[Tuple[str, float]]]:
+        self.refresh()
+        return self._index.search(embeddings, k=k)
+
+    def __len__(self) -> int:
+        self.refresh()
+        return len(self._index)
+
+    def __contains__(self, user_id: str) -> bool:
+        self.refresh()
+        return user_id in self._index
+
+
+@contextmanager
+def _directory_lock(directory: str):
+    """Exclusive advisory lock on the index directory, shared by all processes"""
+    os.makedirs(directory, exist_ok=True)
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _remove_stale_matrices(directory: str, keep: str):
+    cutoff = time.time() - STALE_MATRIX_SECONDS
+    for name in os.listdir(directory):
+        if not (name.startswith("embeddings-") and name.endswith(".npy")) or name == keep:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _read_manifest(path: str) -> dict:
+    with open(path) as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, dict) or not {"matrix", "rows", "user_ids"} <= set(manifest):
+        raise ValueError(f"Malformed embedding index manifest: {path}")
+    if os.path.basename(manifest["matrix"]) != manifest["matrix"]:
+        raise ValueError(f"Embedding matrix must live next to the manifest: {manifest['matrix']!r}")
+    return manifest
@@ -0,0 +1,461 @@
+"""Compact columnar encoding for stored detection history.
+
+`detection_history` and `cheating_events` used to be stored as JSON text, which
+repeats every key, the gaze metrics dict and the hex integrity hash on every
+row. Here each field becomes one typed NumPy column (timestamps as int64
+microseconds, hashes as raw 32-byte rows, list fields as offsets + codes) and
+all strings are interned into a single table per blob. The blob is optionally
+zlib-compressed.
+
+Stored columns are appended to segment by segment (see append_record), so a
+new frame never re-encodes the whole history, and report aggregates are read
+from the columns directly (see summarize_detection_history).
+
+Encoding is lossless: unpack_records() gives back exactly the JSON shape that
+went in. Records that don't fit the schema are stored as plain JSON instead,
+and plain JSON (including existing rows) is always accepted on read.
+"""
+import base64
+import json
+import math
+import struct
+import zlib
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+# Text-column marker for packed blobs; anything else is read as legacy JSON
+PACKED_PREFIX = "cmh1:"
+FLAG_ZLIB = 0x01
+DEFAULT_SEGMENT_SIZE = 20
+
+# Field kinds, in the order fields appear in the exported JSON
+DETECTION_SCHEMA = [
+    ("session_id", "string"),
+    ("timestamp", "timestamp"),
+    ("faces_detected", "int"),
+    ("multiple_faces", "bool"),
+    ("face_details", "faces"),
+    ("suspicious_behaviors", "string_list"),
+    ("cheating_indicators", "indicators"),
+    ("detected_objects", "string_list"),
+    ("warnings", "string_list"),
+    ("recommendations", "string_list"),
+    ("suspicion_level", "string"),
+    ("cheating_probability", "float"),
+    ("random_check", "bool"),
+    ("looking_away", "bool"),
+    ("gaze_metrics", "gaze"),
+    ("attention_score", "float"),
+    ("integrity_hash", "hash"),
+]
+
+CHEATING_EVENT_SCHEMA = [
+    ("timestamp", "timestamp"),
+    ("suspicion_level", "string"),
+    ("cheating_probability", "float"),
+    ("suspicious_behaviors", "string_list"),
+]
+
+GAZE_FLOAT_KEYS = ("left_horizontal", "right_horizontal", "left_vertical", "right_vertical")
+GAZE_FLAG_KEYS = ("is_left", "is_right", "is_up", "is_down")
+BOUNDING_BOX_KEYS = ("x", "y", "width", "height")
+HASH_BYTES = 32
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+# ============ FIELD CODECS ============
+def _is_float(value) -> bool:
+    # ints are rejected too, so a packed float always exports as a float
+    return isinstance(value, float)
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _check_keys(value, keys, what: str):
+    if not isinstance(value, dict) or set(value) != set(keys):
+        raise ValueError(f"Unexpected {what} shape: {value!r}")
+
+
+def _encode_timestamp(value: str) -> int:
+    dt = datetime.fromisoformat(value)
+    # Only naive timestamps that survive isoformat() unchanged are packed
+    if dt.tzinfo is not None or dt.isoformat() != value:
+        raise ValueError(f"Timestamp does not round-trip: {value!r}")
+    return (dt - _EPOCH) // _MICROSECOND
+
+
+def _decode_timestamp(value: int) -> str:
+    return (_EPOCH + int(value) * _MICROSECOND).isoformat()
+
+
+class _StringTable:
+    """Interns strings into small integer codes"""
+
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def code(self, value: str) -> int:
+        if not isinstance(value, str):
+            raise ValueError(f"Expected string, got {value!r}")
+        if value not in self.codes:
+            self.codes[value] = len(self.strings)
+            self.strings.append(value)
+        return self.codes[value]
+
+
+def _offsets(lengths: List[int]) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _encode_column(name: str, kind: str, values: list, strings: _StringTable) -> Dict[str, np.ndarray]:
+    if kind == "string":
+        return {name: np.array([strings.code(v) for v in values], dtype=np.uint32)}
+
+    if kind == "timestamp":
+        return {name: np.array([_encode_timestamp(v) for v in values], dtype=np.int64)}
+
+    if kind == "int":
+        if not all(_is_int(v) for v in values):
+            raise ValueError(f"Non-integer value in {name}")
+        return {name: np.array(values, dtype=np.int32)}
+
+    if kind == "bool":
+        if not all(isinstance(v, bool) for v in values):
+            raise ValueError(f"Non-boolean value in {name}")
+        return {name: np.array(values, dtype=np.bool_)}
+
+    if kind == "float":
+        if not all(v is None or _is_float(v) for v in values):
+            raise ValueError(f"Non-numeric value in {name}")
+        return {
+            name: np.array([np.nan if v is None else v for v in values], dtype=np.float64),
+            f"{name}.present": np.array([v is not None for v in values], dtype=np.bool_),
+        }
+
+    if kind == "hash":
+        digests = np.zeros((len(values), HASH_BYTES), dtype=np.uint8)
+        present = np.zeros(len(values), dtype=np.bool_)
+        for i, v in enumerate(values):
+            if v == "":
+                continue
+            if not isinstance(v, str) or len(v) != HASH_BYTES * 2 or v != v.lower():
+                raise ValueError(f"Unexpected hash in {name}: {v!r}")
+            digests[i] = np.frombuffer(bytes.fromhex(v), dtype=np.uint8)
+            present[i] = True
+        return {name: digests, f"{name}.present": present}
+
+    if kind == "string_list":
+        if not all(isinstance(v, list) for v in values):
+            raise ValueError(f"Non-list value in {name}")
+        return {
+            f"{name}.offsets": _offsets([len(v) for v in values]),
+            name: np.array([strings.code(s) for v in values for s in v], dtype=np.uint32),
+        }
+
+    if kind == "gaze":
+        metrics = np.full((len(values), len(GAZE_FLOAT_KEYS)), np.nan, dtype=np.float64)
+        flags = np.zeros((len(values), len(GAZE_FLAG_KEYS)), dtype=np.bool_)
+        present = np.zeros(len(values), dtype=np.bool_)
+        for i, v in enumerate(values):
+            if v is None:
+                continue
+            _check_keys(v, GAZE_FLOAT_KEYS + GAZE_FLAG_KEYS, name)
+            if not all(_is_float(v[k]) for k in GAZE_FLOAT_KEYS):
+                raise ValueError(f"Non-numeric gaze metric in {name}")
+            if not all(isinstance(v[k], bool) for k in GAZE_FLAG_KEYS):
+                raise ValueError(f"Non-boolean gaze flag in {name}")
+            metrics[i] = [v[k] for k in GAZE_FLOAT_KEYS]
+            flags[i] = [v[k] for k in GAZE_FLAG_KEYS]
+            present[i] = True
+        return {name: metrics, f"{name}.flags": flags, f"{name}.present": present}
+
+    if kind == "faces":
+        if not all(isinstance(v, list) for v in values):
+            raise ValueError(f"Non-list value in {name}")
+        faces = [face for v in values for face in v]
+        for face in faces:
+            _check_keys(face, ("face_id", "bounding_box", "confidence"), name)
+            _check_keys(face["bounding_box"], BOUNDING_BOX_KEYS, f"{name} bounding box")
+            if not _is_int(face["face_id"]) or not _is_float(face["confidence"]):
+                raise ValueError(f"Unexpected face detail in {name}: {face!r}")
+            if not all(_is_int(face["bounding_box"][k]) for k in BOUNDING_BOX_KEYS):
+                raise ValueError(f"Non-integer bounding box in {name}")
+        return {
+            f"{name}.offsets": _offsets([len(v) for v in values]),
+            f"{name}.face_id": np.array([f["face_id"] for f in faces], dtype=np.int32),
+            f"{name}.bounding_box": np.array(
+                [[f["bounding_box"][k] for k in BOUNDING_BOX_KEYS] for f in faces],
+                dtype=np.int32
+            ).reshape(len(faces), len(BOUNDING_BOX_KEYS)),
+            f"{name}.confidence": np.array([f["confidence"] for f in faces], dtype=np.float64),
+        }
+
+    if kind == "indicators":
+        if not all(isinstance(v, list) for v in values):
+            raise ValueError(f"Non-list value in {name}")
+        indicators = [ind for v in values for ind in v]
+        for ind in indicators:
+            _check_keys(ind, ("indicator_type", "confidence", "description"), name)
+            if not _is_float(ind["confidence"]):
+                raise ValueError(f"Non-numeric confidence in {name}")
+        return {
+            f"{name}.offsets": _offsets([len(v) for v in values]),
+            f"{name}.indicator_type": np.array(
+                [strings.code(ind["indicator_type"]) for ind in indicators], dtype=np.uint32
+            ),
+            f"{name}.confidence": np.array([ind["confidence"] for ind in indicators], dtype=np.float64),
+            f"{name}.description": np.array(
+                [strings.code(ind["description"]) for ind in indicators], dtype=np.uint32
+            ),
+        }
+
+    raise ValueError(f"Unknown field kind: {kind}")
+
+
+def _decode_column(name: str, kind: str, columns: Dict[str, np.ndarray], strings: List[str], n: int) -> list:
+    if kind == "string":
+        return [strings[c] for c in columns[name].tolist()]
+
+    if kind == "timestamp":
+        return [_decode_timestamp(v) for v in columns[name].tolist()]
+
+    if kind in ("int", "bool"):
+        return columns[name].tolist()
+
+    if kind == "float":
+        present = columns[f"{name}.present"].tolist()
+        return [v if p else None for v, p in zip(columns[name].tolist(), present)]
+
+    if kind == "hash":
+        present = columns[f"{name}.present"].tolist()
+        return [row.tobytes().hex() if p else "" for row, p in zip(columns[name], present)]
+
+    if kind == "string_list":
+        offsets = columns[f"{name}.offsets"].tolist()
+        values = [strings[c] for c in columns[name].tolist()]
+        return [values[offsets[i]:offsets[i + 1]] for i in range(n)]
+
+    if kind == "gaze":
+        metrics = columns[name].tolist()
+        flags = columns[f"{name}.flags"].tolist()
+        present = columns[f"{name}.present"].tolist()
+        result = []
+        for i in range(n):
+            if not present[i]:
+                result.append(None)
+                continue
+            gaze = dict(zip(GAZE_FLOAT_KEYS, metrics[i]))
+            gaze.update(zip(GAZE_FLAG_KEYS, flags[i]))
+            result.append(gaze)
+        return result
+
+    if kind == "faces":
+        offsets = columns[f"{name}.offsets"].tolist()
+        faces = [
+            {
+                "face_id": face_id,
+                "bounding_box": dict(zip(BOUNDING_BOX_KEYS, box)),
+                "confidence": confidence,
+            }
+            for face_id, box, confidence in zip(
+                columns[f"{name}.face_id"].tolist(),
+                columns[f"{name}.bounding_box"].tolist(),
+                columns[f"{name}.confidence"].tolist(),
+            )
+        ]
+        return [faces[offsets[i]:offsets[i + 1]] for i in range(n)]
+
+    if kind == "indicators":
+        offsets = columns[f"{name}.offsets"].tolist()
+        indicators = [
+            {
+                "indicator_type": strings[type_code],
+                "confidence": confidence,
+                "description": strings[description_code],
+            }
+            for type_code, confidence, description_code in zip(
+                columns[f"{name}.indicator_type"].tolist(),
+                columns[f"{name}.confidence"].tolist(),
+                columns[f"{name}.description"].tolist(),
+            )
+        ]
+        return [indicators[offsets[i]:offsets[i + 1]] for i in range(n)]
+
+    raise ValueError(f"Unknown field kind: {kind}")
+
+
+# ============ BINARY FORMAT ============
+def encode_records(records: List[Dict[str, Any]], schema, compress: bool = True) -> bytes:
+    """Encode records into a columnar blob. Raises ValueError if a record doesn't fit the schema.
+
+    Layout: flags byte, then (optionally zlib-compressed) a little-endian u32
+    header length, a JSON header listing the string table and each column's
+    dtype and shape, and the raw column buffers back to back.
+    """
+    field_names = [name for name, _ in schema]
+    for record in records:
+        if not isinstance(record, dict) or list(record) != field_names:
+            raise ValueError("Record does not match schema")
+
+    strings = _StringTable()
+    columns = {}
+    for name, kind in schema:
+        columns.update(_encode_column(name, kind, [r[name] for r in records], strings))
+
+    header = {
+        "n": len(records),
+        "strings": strings.strings,
+        "columns": [[key, arr.dtype.str, list(arr.shape)] for key, arr in columns.items()],
+    }
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    body = b"".join(
+        [struct.pack("<I", len(header_bytes)), header_bytes]
+        + [np.ascontiguousarray(arr).tobytes() for arr in columns.values()]
+    )
+
+    flags = 0
+    if compress:
+        body = zlib.compress(body)
+        flags |= FLAG_ZLIB
+    return bytes([flags]) + body
+
+
+def decode_columns(blob: bytes, keys=None) -> Tuple[int, List[str], Dict[str, np.ndarray]]:
+    """Decode a blob into (row count, string table, column arrays) without building records.
+
+    With keys given, only those columns are materialized.
+    """
+    flags, body = blob[0], blob[1:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+
+    (header_len,) = struct.unpack_from("<I", body)
+    header = json.loads(body[4:4 + header_len].decode("utf-8"))
+
+    columns = {}
+    position = 4 + header_len
+    for key, dtype, shape in header["columns"]:
+        dtype = np.dtype(dtype)
+        count = math.prod(shape)
+        if keys is None or key in keys:
+            columns[key] = np.frombuffer(body, dtype=dtype, count=count, offset=position).reshape(shape)
+        position += count * dtype.itemsize
+    return header["n"], header["strings"], columns
+
+
+def decode_records(blob: bytes, schema) -> List[Dict[str, Any]]:
+    """Decode a blob back into the original JSON-shaped records"""
+    n, strings, columns = decode_columns(blob)
+    fields = [(name, _decode_column(name, kind, columns, strings, n)) for name, kind in schema]
+    return [{name: values[i] for name, values in fields} for i in range(n)]
+
+
+# ============ TEXT COLUMN HELPERS ============
+# A stored column is a newline-separated list of segments, oldest first. Each
+# segment is a packed blob or a JSON array; legacy rows are a single JSON
+# segment. Only the last segment may be an open JSON "tail", so appending a
+# record parses at most segment_size records instead of the whole history.
+def _segments(text: Optional[str]) -> List[str]:
+    return text.split("\n") if text else []
+
+
+def _is_packed(segment: str) -> bool:
+    return segment.startswith(PACKED_PREFIX)
+
+
+def _decode_segment(segment: str) -> bytes:
+    return base64.b64decode(segment[len(PACKED_PREFIX):])
+
+
+def pack_records(records: List[Dict[str, Any]], schema, compress: bool = True) -> str:
+    """Serialize records as one segment, falling back to JSON if they don't fit the schema"""
+    if not records:
+        return "[]"
+    try:
+        blob = encode_records(records, schema, compress=compress)
+    except (ValueError, TypeError, KeyError, OverflowError):
+        return json.dumps(records)
+    return PACKED_PREFIX + base64.b64encode(blob).decode("ascii")
+
+
+def append_record(
+    text: Optional[str],
+    record: Dict[str, Any],
+    schema,
+    max_records: Optional[int] = None,
+    segment_size: int = DEFAULT_SEGMENT_SIZE,
+    compress: bool = True
+) -> str:
+    """Append a record to a stored column without decoding its packed segments.
+
+    Records collect in a JSON tail that is packed once it holds segment_size
+    records. With max_records set, the oldest whole segments are dropped, so
+    the column keeps between max_records and max_records + segment_size - 1
+    records once it is full.
+    """
+    segments = _segments(text)
+    tail = []
+    if segments and not _is_packed(segments[-1]):
+        tail = json.loads(segments.pop())
+    tail.append(record)
+
+    if len(tail) >= segment_size:
+        segments.append(pack_records(tail, schema, compress=compress))
+        tail = []
+
+    if max_records is not None:
+        max_segments = max(1, -(-max_records // segment_size))
+        segments = segments[-max_segments:]
+    if tail:
+        segments.append(json.dumps(tail))
+    return "\n".join(segments) if segments else "[]"
+
+
+def unpack_records(text: Optional[str], schema) -> List[Dict[str, Any]]:
+    """Read a stored column back into the original JSON-shaped records"""
+    records = []
+    for segment in _segments(text):
+        if _is_packed(segment):
+            records.extend(decode_records(_decode_segment(segment), schema))
+        else:
+            records.extend(json.loads(segment))
+    return records
+
+
+_SUMMARY_COLUMNS = {"cheating_probability", "cheating_probability.present", "suspicious_behaviors"}
+
+
+def summarize_detection_history(text: Optional[str]) -> Tuple[float, List[str]]:
+    """Average cheating probability and distinct suspicious behaviors of a stored history.
+
+    Packed segments are read straight from their columns, without building
+    per-record dicts.
+    """
+    probability_sum = 0.0
+    row_count = 0
+    behaviors = {}
+    for segment in _segments(text):
+        if _is_packed(segment):
+            n, strings, columns = decode_columns(_decode_segment(segment), keys=_SUMMARY_COLUMNS)
+            probabilities = columns["cheating_probability"][columns["cheating_probability.present"]]
+            probability_sum += float(probabilities.sum())
+            row_count += n
+            for code in np.unique(columns["suspicious_behaviors"]).tolist():
+                behaviors.setdefault(strings[code], None)
+        else:
+            for h in json.loads(segment):
+                probability_sum += h.get('cheating_probability') or 0
+                row_count += 1
+                for b in h.get('suspicious_behaviors', []):
+                    behaviors.setdefault(b, None)
+    average = probability_sum / row_count if row_count else 0
+    return average, list(behaviors)
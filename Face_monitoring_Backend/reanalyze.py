@@ -0,0 +1,353 @@
+"""Offline re-analysis of recorded interview footage.
+
+Streams frames from a recorded video (or a directory of frame images) through
+the same detection path used by /detect-cheating/, fanning the work out over a
+process pool. Frames are decoded lazily and only a bounded window is ever in
+flight, so memory stays flat no matter how long the recording is.
+
+Usage:
+    python reanalyze.py --video interview.mp4 --reference face.jpg --out results/
+    python reanalyze.py --frames-dir frames/ --reference face.jpg --out results/
+"""
+import os
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional, Iterator, Iterable, Tuple, Dict, Any
+
+import cv2
+
+from v7 import (
+    MAX_SESSION_HISTORY,
+    RANDOM_CHECK_PROBABILITY,
+    SuspicionLevel,
+    analyze_frame_optimized,
+    calculate_hash,
+    embedding_index,
+    generate_session_id,
+    preprocess_image,
+)
+
+logger = logging.getLogger("anti_cheat_reanalyze")
+
+# Constants
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+IN_FLIGHT_PER_WORKER = 4
+DEFAULT_FRAMES_DIR_FPS = 1.0
+
+# Per-process state, populated by _init_worker
+_worker_reference_img = None
+_worker_reference_cache = {}
+
+
+# ============ FRAME SOURCES ============
+def iter_video_frames(video_path: str, every: int = 1) -> Iterator[Tuple[float, bytes]]:
+    """Yield (offset_seconds, jpeg_bytes) for every `every`-th frame of a video"""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video: {video_path}")
+
+    fps = cap.get(cv2.CAP_PROP_FPS) or 0.0
+    try:
+        index = 0
+        while True:
+            # grab() skips the decode for frames we are not going to analyze
+            if index % every != 0:
+                if not cap.grab():
+                    break
+                index += 1
+                continue
+
+            ok, frame = cap.read()
+            if not ok:
+                break
+            if fps > 0:
+                offset = index / fps
+            else:
+                offset = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+            if ok:
+                yield offset, buffer.tobytes()
+            index += 1
+    finally:
+        cap.release()
+
+
+def iter_directory_frames(
+    frames_dir: str,
+    fps: float = DEFAULT_FRAMES_DIR_FPS,
+    every: int = 1
+) -> Iterator[Tuple[float, bytes]]:
+    """Yield (offset_seconds, image_bytes) for image files in name order"""
+    names = sorted(
+        name for name in os.listdir(frames_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    for index, name in enumerate(names):
+        if index % every != 0:
+            continue
+        with open(os.path.join(frames_dir, name), "rb") as f:
+            yield index / fps, f.read()
+
+
+# ============ WORKER ============
+def _init_worker(reference_contents: Optional[bytes]):
+    global _worker_reference_img
+    _worker_reference_img = (
+        preprocess_image(reference_contents) if reference_contents else None
+    )
+
+
+def _analyze_frame_worker(
+    contents: bytes,
+    user_id: str,
+    session_id: str,
+    timestamp: str,
+    random_check: bool,
+    frame_count: int
+) -> Optional[dict]:
+    """Run a single frame through the live detection path inside a worker"""
+    img = preprocess_image(contents)
+    if img is None:
+        return None
+
+    result = analyze_frame_optimized(
+        img,
+        _worker_reference_img,
+        user_id,
+        session_id,
+        session_history=deque(maxlen=MAX_SESSION_HISTORY),
+        context_data={},
+        random_check=random_check,
+        frame_count=frame_count,
+        reference_cache=_worker_reference_cache
+    )
+    result.timestamp = timestamp
+    result.integrity_hash = calculate_hash(contents)
+    return json.loads(json.dumps(result.dict(), default=str))
+
+
+# ============ PIPELINE ============
+def iter_frame_results(
+    frames: Iterable[Tuple[float, bytes]],
+    reference_contents: Optional[bytes],
+    user_id: str,
+    session_id: str,
+    start_time: datetime,
+    workers: int,
+    seed: int = 0
+) -> Iterator[Tuple[float, Optional[dict]]]:
+    """Analyze frames across a process pool, yielding results in frame order.
+
+    At most workers * IN_FLIGHT_PER_WORKER frames are submitted at once; the
+    oldest future is always drained first, so output order matches input order.
+    """
+    rng = random.Random(seed)
+    max_in_flight = workers * IN_FLIGHT_PER_WORKER
+    # spawn gives every worker its own MediaPipe graphs instead of forked copies
+    mp_context = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp_context,
+        initializer=_init_worker,
+        initargs=(reference_contents,)
+    ) as pool:
+        pending = deque()
+        for frame_count, (offset, contents) in enumerate(frames, start=1):
+            timestamp = (start_time + timedelta(seconds=offset)).isoformat()
+            random_check = rng.random() < RANDOM_CHECK_PROBABILITY
+            future = pool.submit(
+                _analyze_frame_worker,
+                contents,
+                user_id,
+                session_id,
+                timestamp,
+                random_check,
+                frame_count
+            )
+            pending.append((offset, future))
+
+            if len(pending) >= max_in_flight:
+                done_offset, done_future = pending.popleft()
+                yield done_offset, done_future.result()
+
+        while pending:
+            done_offset, done_future = pending.popleft()
+            yield done_offset, done_future.result()
+
+
+def _write_report(report_path: str, report: Dict[str, Any], events_path: str):
+    """Write the report JSON, streaming the cheating_events array from events_path"""
+    with open(report_path, "w") as report_file, open(events_path) as events_file:
+        report_file.write("{\n")
+        report_file.write(f'  "session_summary": {json.dumps(report["session_summary"])},\n')
+        report_file.write('  "cheating_events": [')
+        for i, line in enumerate(events_file):
+            report_file.write(("," if i else "") + "\n    " + line.rstrip("\n"))
+        report_file.write("\n  ],\n")
+        tail = [
+            f'  "{key}": {json.dumps(value)}'
+            for key, value in report.items()
+            if key not in ("session_summary", "cheating_events_path")
+        ]
+        report_file.write(",\n".join(tail) + "\n}\n")
+
+
+def write_results_and_report(
+    results: Iterable[Tuple[float, Optional[dict]]],
+    session_id: str,
+    user_id: str,
+    start_time: datetime,
+    out_dir: str
+) -> Dict[str, Any]:
+    """Stream per-frame records and cheating events to JSON Lines and build the session report.
+
+    The report mirrors get_session_report() so re-analysis output can be
+    compared field-for-field with the live session. Only counters are kept in
+    memory; the report's cheating_events array is copied from the events file,
+    and the returned dict carries its path instead of the events themselves.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    frames_path = os.path.join(out_dir, f"{session_id}_frames.jsonl")
+    events_path = os.path.join(out_dir, f"{session_id}_events.jsonl")
+
+    frame_count = 0
+    skipped_frames = 0
+    warnings_issued = 0
+    looking_away_count = 0
+    cheating_event_count = 0
+    probability_sum = 0.0
+    last_offset = 0.0
+    suspicious_behaviors = set()
+
+    with open(frames_path, "w") as frames_file, open(events_path, "w") as events_file:
+        for offset, result in results:
+            last_offset = offset
+            if result is None:
+                skipped_frames += 1
+                continue
+
+            frames_file.write(json.dumps(result) + "\n")
+            frame_count += 1
+            probability_sum += result.get('cheating_probability', 0)
+            suspicious_behaviors.update(result.get('suspicious_behaviors', []))
+
+            if result.get('suspicion_level') in [SuspicionLevel.HIGH, SuspicionLevel.CRITICAL]:
+                events_file.write(json.dumps({
+                    'timestamp': result['timestamp'],
+                    'suspicion_level': result['suspicion_level'],
+                    'cheating_probability': result['cheating_probability'],
+                    'suspicious_behaviors': result.get('suspicious_behaviors', [])
+                }) + "\n")
+                cheating_event_count += 1
+            if result.get('looking_away'):
+                looking_away_count += 1
+            if len(result.get('warnings', [])) > 0:
+                warnings_issued += 1
+
+            if frame_count % 100 == 0:
+                logger.info(f"Re-analyzed {frame_count} frames ({offset:.1f}s)")
+
+    report = {
+        'session_summary': {
+            'session_id': session_id,
+            'user_id': user_id,
+            'session_duration': last_offset,
+            'total_frames': frame_count,
+            'skipped_frames': skipped_frames,
+            'warnings_issued': warnings_issued,
+            'looking_away_count': looking_away_count,
+            'start_time': start_time.isoformat(),
+            'last_activity': (start_time + timedelta(seconds=last_offset)).isoformat(),
+        },
+        'cheating_events_path': events_path,
+        'suspicious_behaviors': sorted(suspicious_behaviors),
+        'average_suspicion': probability_sum / frame_count if frame_count else 0,
+        'total_cheating_events': cheating_event_count
+    }
+
+    report_path = os.path.join(out_dir, f"{session_id}_report.json")
+    _write_report(report_path, report, events_path)
+
+    logger.info(f"Wrote {frame_count} frame results to {frames_path}")
+    logger.info(f"Wrote {cheating_event_count} cheating events to {events_path}")
+    logger.info(f"Wrote session report to {report_path}")
+    return report
+
+
+# ============ CLI ============
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Re-analyze a recorded interview session offline"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--video", help="Recorded video file to decode")
+    source.add_argument("--frames-dir", help="Directory of frame images, analyzed in name order")
+    parser.add_argument("--reference", help="Reference face image for identity verification")
+    parser.add_argument("--out", required=True, help="Output directory for frame records and report")
+    parser.add_argument("--session-id", help="Session ID to stamp on results (default: new ID)")
+    parser.add_argument("--user-id", default="unknown",
+                        help="Registered user ID the session belongs to; without --reference, "
+                             "identity checks only run for users in the embedding index")
+    parser.add_argument("--start-time", help="ISO timestamp of the first frame (default: now)")
+    parser.add_argument("--fps", type=float, default=DEFAULT_FRAMES_DIR_FPS,
+                        help="Frame rate of --frames-dir captures, used for timestamps")
+    parser.add_argument("--every", type=int, default=1, help="Only analyze every Nth frame")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes (default: all cores)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for random identity checks, for reproducible runs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.every < 1:
+        raise SystemExit("--every must be at least 1")
+    if args.fps <= 0:
+        raise SystemExit("--fps must be positive")
+
+    session_id = args.session_id or generate_session_id()
+    start_time = datetime.fromisoformat(args.start_time) if args.start_time else datetime.now()
+
+    reference_contents = None
+    if args.reference:
+        with open(args.reference, "rb") as f:
+            reference_contents = f.read()
+
+    if args.video:
+        frames = iter_video_frames(args.video, every=args.every)
+    else:
+        frames = iter_directory_frames(args.frames_dir, fps=args.fps, every=args.every)
+
+    if args.reference is None and args.user_id not in embedding_index:
+        logger.warning(
+            f"No --reference given and user {args.user_id} is not in the embedding index; "
+            f"identity verification and impersonation screening are disabled for this run"
+        )
+
+    logger.info(f"Re-analyzing session {session_id} with {args.workers} workers")
+    results = iter_frame_results(
+        frames,
+        reference_contents,
+        args.user_id,
+        session_id,
+        start_time,
+        workers=max(1, args.workers),
+        seed=args.seed
+    )
+    report = write_results_and_report(results, session_id, args.user_id, start_time, args.out)
+    logger.info(
+        f"Session {session_id}: {report['session_summary']['total_frames']} frames, "
+        f"{report['total_cheating_events']} cheating events"
+    )
+
+
+if __name__ == "__main__":
+    main()
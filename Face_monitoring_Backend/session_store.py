@@ -0,0 +1,325 @@
+"""Exam session persistence: SQLAlchemy models and session/report DB functions.
+
+Kept free of the CV stack (DeepFace, MediaPipe, OpenCV) so it can be used
+and tested against any SQLAlchemy session.
+"""
+import json
+import logging
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Column, String, Integer, Text, DateTime, Boolean
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+
+from history_codec import (
+    DETECTION_SCHEMA,
+    CHEATING_EVENT_SCHEMA,
+    append_record,
+    unpack_records,
+    summarize_detection_history,
+)
+
+logger = logging.getLogger("anti_cheat_api")
+
+# Constants
+COMPRESS_DETECTION_HISTORY = True
+MAX_STORED_HISTORY = 100
+HISTORY_SEGMENT_SIZE = 20
+
+Base = declarative_base()
+
+# ============ DATABASE MODELS ============
+class ExamSessionDB(Base):
+    __tablename__ = "exam_sessions"
+    
+    session_id = Column(String(50), primary_key=True)
+    user_id = Column(String(100), nullable=False, index=True)
+    start_time = Column(DateTime, default=datetime.now)
+    last_activity = Column(DateTime, default=datetime.now)
+    end_time = Column(DateTime, nullable=True)
+    
+    # Session state
+    frame_count = Column(Integer, default=0)
+    warnings_issued = Column(Integer, default=0)
+    looking_away_count = Column(Integer, default=0)
+    auth_failures = Column(Integer, default=0)
+    
+    # Detection data (packed by history_codec; legacy rows hold plain JSON)
+    cheating_events = Column(Text, default="[]")
+    detection_history = Column(Text, default="[]")
+    
+    # Reference data
+    reference_image_hash = Column(String(255), nullable=True)
+    baseline_established = Column(Boolean, default=False)
+
+class SessionReportDB(Base):
+    """Final report frozen when a session ends; written once, never updated"""
+    __tablename__ = "exam_session_reports"
+
+    session_id = Column(String(50), primary_key=True)
+    user_id = Column(String(100), nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.now)
+    report = Column(Text, nullable=False)
+
+class SessionArchiveDB(Base):
+    """Raw per-frame data moved out of exam_sessions once a session ends"""
+    __tablename__ = "exam_session_archive"
+
+    session_id = Column(String(50), primary_key=True)
+    user_id = Column(String(100), nullable=False, index=True)
+    archived_at = Column(DateTime, default=datetime.now)
+    cheating_events = Column(Text, default="[]")
+    detection_history = Column(Text, default="[]")
+
+
+# ============ DATABASE FUNCTIONS ============
+def get_or_create_session_db(session_id: str, user_id: str, db: Session):
+    """Get existing session from DB or create new one"""
+    db_session = db.query(ExamSessionDB).filter(
+        ExamSessionDB.session_id == session_id
+    ).first()
+    
+    if not db_session:
+        db_session = ExamSessionDB(
+            session_id=session_id,
+            user_id=user_id,
+            start_time=datetime.now(),
+            last_activity=datetime.now()
+        )
+        db.add(db_session)
+        db.commit()
+        db.refresh(db_session)
+        logger.info(f"Created new session in DB: {session_id}")
+    
+    return db_session
+
+def save_frame_result(session_id: str, detection_result: dict, db: Session) -> bool:
+    """Save individual frame detection result to database.
+
+    Returns False if the session has already ended; its data is frozen and
+    the frame is not recorded.
+    """
+    try:
+        # Row lock: finalize_session_db must not archive between our read and commit
+        db_session = db.query(ExamSessionDB).filter(
+            ExamSessionDB.session_id == session_id
+        ).with_for_update().first()
+        
+        if db_session and db_session.end_time:
+            db.rollback()
+            logger.warning(f"Dropped frame for ended session {session_id}")
+            return False
+        
+        if db_session:
+            # Update frame count and last activity
+            db_session.frame_count += 1
+            db_session.last_activity = datetime.now()
+            
+            # Append to detection history (keep roughly the last MAX_STORED_HISTORY)
+            db_session.detection_history = append_record(
+                db_session.detection_history,
+                detection_result,
+                DETECTION_SCHEMA,
+                max_records=MAX_STORED_HISTORY,
+                segment_size=HISTORY_SEGMENT_SIZE,
+                compress=COMPRESS_DETECTION_HISTORY
+            )
+            
+            # Update cheating events if suspicious
+            if detection_result.get('suspicion_level') in ['high', 'critical']:
+                db_session.cheating_events = append_record(
+                    db_session.cheating_events,
+                    {
+                        'timestamp': detection_result['timestamp'],
+                        'suspicion_level': detection_result['suspicion_level'],
+                        'cheating_probability': detection_result['cheating_probability'],
+                        'suspicious_behaviors': detection_result.get('suspicious_behaviors', [])
+                    },
+                    CHEATING_EVENT_SCHEMA,
+                    segment_size=HISTORY_SEGMENT_SIZE,
+                    compress=COMPRESS_DETECTION_HISTORY
+                )
+            
+            # Update looking away count
+            if detection_result.get('looking_away'):
+                db_session.looking_away_count += 1
+            
+            # Update warnings
+            if len(detection_result.get('warnings', [])) > 0:
+                db_session.warnings_issued += 1
+            
+            db.commit()
+            logger.info(f"Saved frame result for session {session_id}")
+    except Exception as e:
+        logger.error(f"Error saving frame result: {str(e)}")
+        db.rollback()
+    return True
+
+def load_session_from_db(session_id: str, db: Session) -> Optional[dict]:
+    """Load session state from database"""
+    try:
+        db_session = db.query(ExamSessionDB).filter(
+            ExamSessionDB.session_id == session_id
+        ).first()
+        
+        if not db_session:
+            return None
+        
+        return {
+            'session_id': db_session.session_id,
+            'user_id': db_session.user_id,
+            'start_time': db_session.start_time.isoformat(),
+            'last_activity': db_session.last_activity.isoformat(),
+            'end_time': db_session.end_time.isoformat() if db_session.end_time else None,
+            'frame_count': db_session.frame_count,
+            'warnings_issued': db_session.warnings_issued,
+            'looking_away_count': db_session.looking_away_count,
+            'auth_failures': db_session.auth_failures,
+            'cheating_events': unpack_records(db_session.cheating_events, CHEATING_EVENT_SCHEMA),
+            'detection_history': unpack_records(db_session.detection_history, DETECTION_SCHEMA),
+        }
+    except Exception as e:
+        logger.error(f"Error loading session from DB: {str(e)}")
+        return None
+
+def build_session_report(db_session: ExamSessionDB) -> dict:
+    """Compute a session report from the live per-frame data"""
+    cheating_events = unpack_records(db_session.cheating_events, CHEATING_EVENT_SCHEMA)
+    average_suspicion, suspicious_behaviors = summarize_detection_history(
+        db_session.detection_history
+    )
+    
+    duration = (db_session.last_activity - db_session.start_time).total_seconds()
+    
+    return {
+        'session_summary': {
+            'session_id': db_session.session_id,
+            'user_id': db_session.user_id,
+            'session_duration': duration,
+            'total_frames': db_session.frame_count,
+            'warnings_issued': db_session.warnings_issued,
+            'looking_away_count': db_session.looking_away_count,
+            'start_time': db_session.start_time.isoformat(),
+            'last_activity': db_session.last_activity.isoformat(),
+        },
+        'cheating_events': cheating_events,
+        'suspicious_behaviors': suspicious_behaviors,
+        'average_suspicion': average_suspicion,
+        'total_cheating_events': len(cheating_events)
+    }
+
+def build_final_report(db_session: ExamSessionDB) -> dict:
+    """Compute the report frozen at session end, adding attention and timeline data"""
+    report = build_session_report(db_session)
+    report['session_summary']['end_time'] = db_session.end_time.isoformat()
+    
+    total_frames = db_session.frame_count or 0
+    looking_away_percentage = (
+        db_session.looking_away_count / total_frames * 100 if total_frames else 0.0
+    )
+    report['looking_away_percentage'] = round(looking_away_percentage, 2)
+    report['attention_score'] = round(100 - looking_away_percentage, 2)
+    
+    timeline = []
+    for event in sorted(report['cheating_events'], key=lambda e: e['timestamp']):
+        elapsed = (datetime.fromisoformat(event['timestamp']) - db_session.start_time).total_seconds()
+        timeline.append({
+            'timestamp': event['timestamp'],
+            'elapsed_seconds': round(elapsed, 3),
+            'suspicion_level': event['suspicion_level'],
+            'suspicious_behaviors': event['suspicious_behaviors'],
+        })
+    report['event_timeline'] = timeline
+    return report
+
+def get_session_report(session_id: str, db: Session) -> Optional[dict]:
+    """Get full session report for analysis"""
+    try:
+        frozen_report = db.query(SessionReportDB).filter(
+            SessionReportDB.session_id == session_id
+        ).first()
+        if frozen_report:
+            return json.loads(frozen_report.report)
+        
+        db_session = db.query(ExamSessionDB).filter(
+            ExamSessionDB.session_id == session_id
+        ).first()
+        
+        if not db_session:
+            return None
+        
+        return build_session_report(db_session)
+    except Exception as e:
+        logger.error(f"Error getting session report: {str(e)}")
+        return None
+
+def finalize_session_db(session_id: str, memory_session: Optional[dict], db: Session) -> Optional[dict]:
+    """End a session: freeze its final report and archive the raw per-frame data.
+
+    Returns the frozen report, or None if the session does not exist. Calling
+    this again for an ended session returns the report written the first time.
+    """
+    frozen_report = db.query(SessionReportDB).filter(
+        SessionReportDB.session_id == session_id
+    ).first()
+    if frozen_report:
+        return json.loads(frozen_report.report)
+    
+    # Row lock: waits for any in-flight save_frame_result on this session
+    db_session = db.query(ExamSessionDB).filter(
+        ExamSessionDB.session_id == session_id
+    ).with_for_update().first()
+    if not db_session:
+        db.rollback()
+        return None
+    if db_session.end_time:
+        # Finalized while we waited for the lock
+        db.rollback()
+        frozen_report = db.query(SessionReportDB).filter(
+            SessionReportDB.session_id == session_id
+        ).first()
+        return json.loads(frozen_report.report) if frozen_report else None
+    
+    try:
+        # Flush state that is only tracked in memory
+        if memory_session:
+            db_session.last_activity = max(
+                db_session.last_activity,
+                datetime.fromisoformat(memory_session["last_activity"])
+            )
+            db_session.auth_failures = memory_session["auth_failures"]
+        
+        db_session.end_time = datetime.now()
+        report = build_final_report(db_session)
+        
+        db.add(SessionReportDB(
+            session_id=session_id,
+            user_id=db_session.user_id,
+            created_at=db_session.end_time,
+            report=json.dumps(report, default=str)
+        ))
+        db.add(SessionArchiveDB(
+            session_id=session_id,
+            user_id=db_session.user_id,
+            archived_at=db_session.end_time,
+            cheating_events=db_session.cheating_events,
+            detection_history=db_session.detection_history
+        ))
+        db_session.cheating_events = "[]"
+        db_session.detection_history = "[]"
+        
+        db.commit()
+        logger.info(f"Finalized session {session_id}")
+        return report
+    except IntegrityError:
+        # Another request froze the report first; that one stands
+        db.rollback()
+        frozen_report = db.query(SessionReportDB).filter(
+            SessionReportDB.session_id == session_id
+        ).first()
+        return json.loads(frozen_report.report) if frozen_report else None
+    except Exception:
+        db.rollback()
+        raise
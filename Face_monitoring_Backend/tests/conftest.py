@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Backend modules are imported as top-level modules, as uvicorn does with v7:app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
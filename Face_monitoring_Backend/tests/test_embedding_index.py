@@ -0,0 +1,196 @@
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+
+import embedding_index
+from embedding_index import (
+    MANIFEST_FILENAME,
+    STALE_MATRIX_SECONDS,
+    EmbeddingIndex,
+    SharedEmbeddingIndex,
+)
+
+DIM = 128
+
+
+@pytest.fixture
+def embeddings():
+    return np.random.default_rng(0).normal(size=(150, DIM)).astype(np.float32)
+
+
+@pytest.fixture
+def index(embeddings):
+    index = EmbeddingIndex(DIM)
+    for i, embedding in enumerate(embeddings):
+        index.add(f"user{i}", embedding)
+    return index
+
+
+def test_search_returns_top_k_best_first(index, embeddings):
+    results = index.search(embeddings[[5, 17]] + 0.01, k=3)
+    assert [r[0][0] for r in results] == ["user5", "user17"]
+    for matches in results:
+        assert len(matches) == 3
+        scores = [score for _, score in matches]
+        assert scores == sorted(scores, reverse=True)
+        assert scores[0] == pytest.approx(1.0, abs=1e-3)
+
+
+def test_search_with_k_above_size_returns_everything(index, embeddings):
+    matches = index.search(embeddings[3], k=1000)[0]
+    assert len(matches) == len(index)
+    assert matches[0][0] == "user3"
+
+
+def test_score_is_cosine_similarity(index, embeddings):
+    a, b = embeddings[0], embeddings[1]
+    expected = float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+    assert index.score("user1", a) == pytest.approx(expected, abs=1e-5)
+    assert index.score("missing", a) is None
+
+
+def test_add_replaces_existing_user(index, embeddings):
+    index.add("user0", embeddings[42])
+    assert len(index) == len(embeddings)
+    assert index.score("user0", embeddings[42]) == pytest.approx(1.0, abs=1e-5)
+
+
+def test_remove_keeps_other_rows_intact(index, embeddings):
+    assert index.remove("user5")
+    assert not index.remove("user5")
+    assert "user5" not in index
+    assert len(index) == len(embeddings) - 1
+    assert index.search(embeddings[5])[0][0][0] != "user5"
+    # user149 was moved into the freed row
+    assert index.search(embeddings[149])[0][0][0] == "user149"
+    for i in (0, 6, 100, 149):
+        assert index.score(f"user{i}", embeddings[i]) == pytest.approx(1.0, abs=1e-5)
+
+
+def test_empty_index():
+    index = EmbeddingIndex(DIM)
+    assert index.search(np.ones(DIM)) == [[]]
+    with pytest.raises(ValueError):
+        index.add("user", np.ones(DIM + 1))
+
+
+def test_save_and_load_round_trip(tmp_path, index, embeddings):
+    index.save(str(tmp_path))
+    loaded = EmbeddingIndex.load(str(tmp_path), DIM)
+    assert isinstance(loaded._matrix, np.memmap)
+    assert loaded.user_ids == index.user_ids
+
+    # Mutating a loaded index copies the mapped matrix instead of writing to it
+    loaded.add("new", embeddings[7])
+    loaded.remove("user0")
+    assert loaded.search(embeddings[7], k=2)[0][0][0] in {"new", "user7"}
+    assert EmbeddingIndex.load(str(tmp_path), DIM).user_ids == index.user_ids
+
+
+def test_save_keeps_previous_matrix_until_stale(tmp_path, index):
+    index.save(str(tmp_path))
+    first = [name for name in os.listdir(tmp_path) if name.endswith(".npy")]
+    index.remove("user1")
+    index.save(str(tmp_path))
+    assert set(first) < set(name for name in os.listdir(tmp_path) if name.endswith(".npy"))
+
+    stale = time.time() - STALE_MATRIX_SECONDS - 1
+    os.utime(tmp_path / first[0], (stale, stale))
+    index.save(str(tmp_path))
+    matrices = [name for name in os.listdir(tmp_path) if name.endswith(".npy")]
+    assert first[0] not in matrices
+    assert len(EmbeddingIndex.load(str(tmp_path), DIM)) == len(index)
+
+
+def test_load_of_superseded_manifest_keeps_registrations(tmp_path, index, monkeypatch):
+    index.save(str(tmp_path))
+    manifest_path = tmp_path / MANIFEST_FILENAME
+    old_manifest = json.loads(manifest_path.read_text())
+
+    # Another process saves and its old matrix is gone by the time we open it
+    index.save(str(tmp_path))
+    os.remove(tmp_path / old_manifest["matrix"])
+    reads = []
+    real_read_manifest = embedding_index._read_manifest
+
+    def read_manifest(path):
+        reads.append(path)
+        return old_manifest if len(reads) == 1 else real_read_manifest(path)
+
+    monkeypatch.setattr(embedding_index, "_read_manifest", read_manifest)
+    loaded = EmbeddingIndex.load_or_create(str(tmp_path), DIM)
+
+    assert loaded.user_ids == index.user_ids
+    assert manifest_path.exists()
+    assert not [name for name in os.listdir(tmp_path) if ".corrupt-" in name]
+
+
+def test_load_or_create_raises_on_missing_matrix(tmp_path, index):
+    index.save(str(tmp_path))
+    for name in os.listdir(tmp_path):
+        if name.endswith(".npy"):
+            os.remove(tmp_path / name)
+    with pytest.raises(FileNotFoundError):
+        EmbeddingIndex.load_or_create(str(tmp_path), DIM)
+    assert (tmp_path / MANIFEST_FILENAME).exists()
+
+
+def test_manifest_row_count_mismatch_is_detected(tmp_path, index):
+    index.save(str(tmp_path))
+    manifest_path = tmp_path / MANIFEST_FILENAME
+    manifest = json.loads(manifest_path.read_text())
+    manifest["rows"] -= 1
+    manifest_path.write_text(json.dumps(manifest))
+    with pytest.raises(ValueError):
+        EmbeddingIndex.load(str(tmp_path), DIM)
+
+
+def test_load_or_create_moves_unreadable_index_aside(tmp_path, index, embeddings):
+    index.save(str(tmp_path))
+    manifest_path = tmp_path / MANIFEST_FILENAME
+    good_manifest = manifest_path.read_text()
+    manifest_path.write_text("{not json")
+
+    recovered = EmbeddingIndex.load_or_create(str(tmp_path), DIM)
+    assert len(recovered) == 0
+    assert not manifest_path.exists()
+    assert any(name.startswith(MANIFEST_FILENAME + ".corrupt-") for name in os.listdir(tmp_path))
+
+    # A later save must not destroy the matrix the good manifest pointed at
+    recovered.add("user0", embeddings[0])
+    recovered.save(str(tmp_path))
+    matrix_name = json.loads(good_manifest)["matrix"]
+    assert (tmp_path / matrix_name).exists()
+
+
+def test_load_or_create_without_saved_index(tmp_path):
+    assert len(EmbeddingIndex.load_or_create(str(tmp_path / "missing"), DIM)) == 0
+
+
+def test_shared_index_sees_other_process_writes(tmp_path, embeddings):
+    worker_a = SharedEmbeddingIndex(str(tmp_path), DIM)
+    worker_b = SharedEmbeddingIndex(str(tmp_path), DIM)
+
+    worker_a.add("user0", embeddings[0])
+    assert "user0" in worker_b
+    assert worker_b.search(embeddings[0])[0][0][0] == "user0"
+
+    worker_b.remove("user0")
+    assert "user0" not in worker_a
+    assert len(worker_a) == 0
+
+
+def test_shared_index_writers_do_not_overwrite_each_other(tmp_path, embeddings):
+    worker_a = SharedEmbeddingIndex(str(tmp_path), DIM)
+    worker_b = SharedEmbeddingIndex(str(tmp_path), DIM)
+
+    # Neither worker reads in between, so each holds a stale copy when writing
+    worker_a.add("user0", embeddings[0])
+    worker_b.add("user1", embeddings[1])
+    worker_a.add("user2", embeddings[2])
+
+    reloaded = EmbeddingIndex.load(str(tmp_path), DIM)
+    assert sorted(reloaded.user_ids) == ["user0", "user1", "user2"]
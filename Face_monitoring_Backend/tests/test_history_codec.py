@@ -0,0 +1,154 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from history_codec import (
+    CHEATING_EVENT_SCHEMA,
+    DETECTION_SCHEMA,
+    PACKED_PREFIX,
+    append_record,
+    decode_records,
+    encode_records,
+    pack_records,
+    summarize_detection_history,
+    unpack_records,
+)
+
+START = datetime(2025, 4, 20, 13, 46, 43, 123456)
+
+
+def make_frame(i, looking_away=False, gaze=True, faces=1):
+    record = {
+        "session_id": "A1B2C3D4-E5F",
+        "timestamp": (START + timedelta(seconds=2.5 * i)).isoformat(),
+        "faces_detected": faces,
+        "multiple_faces": faces > 1,
+        "face_details": [
+            {
+                "face_id": f,
+                "bounding_box": {"x": 100 + f, "y": 80, "width": 200, "height": 210},
+                "confidence": 0.91 + f / 100,
+            }
+            for f in range(faces)
+        ],
+        "suspicious_behaviors": ["looking_away"] if looking_away else [],
+        "cheating_indicators": [
+            {
+                "indicator_type": "looking_away",
+                "confidence": 0.85,
+                "description": "Candidate looking away from screen",
+            }
+        ] if looking_away else [],
+        "detected_objects": [],
+        "warnings": ["Please keep your eyes on the screen"] if looking_away else [],
+        "recommendations": [],
+        "suspicion_level": "critical" if looking_away else "low",
+        "cheating_probability": 0.85 if looking_away else 0.0,
+        "random_check": i % 5 == 0,
+        "looking_away": looking_away,
+        "gaze_metrics": {
+            "left_horizontal": 0.31 + i / 1000,
+            "right_horizontal": 0.62,
+            "left_vertical": 0.45,
+            "right_vertical": 0.47,
+            "is_left": True,
+            "is_right": looking_away,
+            "is_up": False,
+            "is_down": False,
+        } if gaze else None,
+        "attention_score": None,
+        "integrity_hash": hashlib.sha256(str(i).encode()).hexdigest(),
+    }
+    # Stored records always come from a JSON round trip
+    return json.loads(json.dumps(record))
+
+
+def make_history(n):
+    return [make_frame(i, looking_away=i % 3 == 0, gaze=i % 7 != 0, faces=1 + (i % 11 == 0)) for i in range(n)]
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_encode_decode_round_trip(compress):
+    history = make_history(50)
+    blob = encode_records(history, DETECTION_SCHEMA, compress=compress)
+    assert json.dumps(decode_records(blob, DETECTION_SCHEMA)) == json.dumps(history)
+
+
+def test_pack_is_smaller_than_json():
+    history = make_history(100)
+    packed = pack_records(history, DETECTION_SCHEMA)
+    assert packed.startswith(PACKED_PREFIX)
+    assert len(packed) * 5 < len(json.dumps(history))
+
+
+def test_cheating_events_round_trip():
+    events = [
+        {
+            "timestamp": (START + timedelta(seconds=i)).isoformat(),
+            "suspicion_level": "critical",
+            "cheating_probability": 0.85,
+            "suspicious_behaviors": ["looking_away", "identity_mismatch"][: 1 + i % 2],
+        }
+        for i in range(10)
+    ]
+    assert unpack_records(pack_records(events, CHEATING_EVENT_SCHEMA), CHEATING_EVENT_SCHEMA) == events
+
+
+@pytest.mark.parametrize("change", [
+    {"cheating_probability": 1},
+    {"timestamp": "2025-04-20T13:46:43+05:30"},
+    {"integrity_hash": "not-a-hash"},
+    {"gaze_metrics": {"left_horizontal": 0.3}},
+])
+def test_records_outside_schema_fall_back_to_json(change):
+    history = [make_frame(0), dict(make_frame(1), **change)]
+    packed = pack_records(history, DETECTION_SCHEMA)
+    assert packed == json.dumps(history)
+    assert unpack_records(packed, DETECTION_SCHEMA) == history
+
+
+def test_legacy_json_is_read():
+    history = make_history(5)
+    assert unpack_records(json.dumps(history), DETECTION_SCHEMA) == history
+    assert unpack_records("[]", DETECTION_SCHEMA) == []
+    assert unpack_records(None, DETECTION_SCHEMA) == []
+
+
+def test_append_record_keeps_a_bounded_window():
+    history = make_history(157)
+    text = "[]"
+    for record in history:
+        text = append_record(text, record, DETECTION_SCHEMA, max_records=100, segment_size=20)
+
+    stored = unpack_records(text, DETECTION_SCHEMA)
+    assert 100 <= len(stored) < 120
+    assert stored == history[-len(stored):]
+    # Only the open tail is kept as JSON
+    segments = text.split("\n")
+    assert all(s.startswith(PACKED_PREFIX) for s in segments[:-1])
+
+
+def test_append_record_continues_a_legacy_history():
+    history = make_history(30)
+    text = json.dumps(history[:25])
+    for record in history[25:]:
+        text = append_record(text, record, DETECTION_SCHEMA, segment_size=20)
+    assert unpack_records(text, DETECTION_SCHEMA) == history
+
+
+def test_summarize_matches_records():
+    history = make_history(67)
+    text = "[]"
+    for record in history:
+        text = append_record(text, record, DETECTION_SCHEMA, segment_size=20)
+
+    average, behaviors = summarize_detection_history(text)
+    assert average == pytest.approx(sum(h["cheating_probability"] for h in history) / len(history))
+    assert set(behaviors) == {"looking_away"}
+
+    legacy_average, legacy_behaviors = summarize_detection_history(json.dumps(history))
+    assert legacy_average == pytest.approx(average)
+    assert legacy_behaviors == behaviors
+    assert summarize_detection_history("[]") == (0, [])
@@ -0,0 +1,182 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import session_store
+from session_store import (
+    Base,
+    ExamSessionDB,
+    SessionArchiveDB,
+    SessionReportDB,
+    finalize_session_db,
+    get_or_create_session_db,
+    get_session_report,
+    load_session_from_db,
+    save_frame_result,
+)
+
+START = datetime(2025, 4, 20, 13, 46, 43)
+SESSION_ID = "A1B2C3D4-E5F"
+
+
+def make_frame(i, looking_away=False):
+    return {
+        "session_id": SESSION_ID,
+        "timestamp": (START + timedelta(seconds=10 * i)).isoformat(),
+        "faces_detected": 1,
+        "multiple_faces": False,
+        "face_details": [],
+        "suspicious_behaviors": ["looking_away"] if looking_away else [],
+        "cheating_indicators": [],
+        "detected_objects": [],
+        "warnings": ["Please keep your eyes on the screen"] if looking_away else [],
+        "recommendations": [],
+        "suspicion_level": "critical" if looking_away else "low",
+        "cheating_probability": 0.85 if looking_away else 0.0,
+        "random_check": False,
+        "looking_away": looking_away,
+        "gaze_metrics": None,
+        "attention_score": None,
+        "integrity_hash": "",
+    }
+
+
+def make_sessionmaker(url="sqlite://"):
+    kwargs = {"poolclass": StaticPool} if url == "sqlite://" else {}
+    engine = create_engine(url, connect_args={"check_same_thread": False}, **kwargs)
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture
+def db():
+    db = make_sessionmaker()()
+    yield db
+    db.close()
+
+
+def start_session(db, frames=4, looking_away_every=2):
+    db.add(ExamSessionDB(session_id=SESSION_ID, user_id="user1", start_time=START, last_activity=START))
+    db.commit()
+    for i in range(frames):
+        assert save_frame_result(SESSION_ID, make_frame(i, looking_away=i % looking_away_every == 1), db)
+
+
+def test_save_frame_result_updates_counters_and_history(db):
+    start_session(db, frames=4)
+    data = load_session_from_db(SESSION_ID, db)
+    assert data["frame_count"] == 4
+    assert data["looking_away_count"] == 2
+    assert data["warnings_issued"] == 2
+    assert data["end_time"] is None
+    assert len(data["detection_history"]) == 4
+    assert [e["timestamp"] for e in data["cheating_events"]] == [
+        make_frame(1)["timestamp"], make_frame(3)["timestamp"]
+    ]
+
+
+def test_get_or_create_session_db_reuses_existing_row(db):
+    created = get_or_create_session_db(SESSION_ID, "user1", db)
+    assert get_or_create_session_db(SESSION_ID, "other", db) is created
+    assert db.query(ExamSessionDB).count() == 1
+
+
+def test_live_report_is_computed_from_history(db):
+    start_session(db, frames=4)
+    report = get_session_report(SESSION_ID, db)
+    assert report["session_summary"]["total_frames"] == 4
+    assert report["total_cheating_events"] == 2
+    assert report["suspicious_behaviors"] == ["looking_away"]
+    assert report["average_suspicion"] == pytest.approx(0.85 / 2)
+    assert "attention_score" not in report
+
+
+def test_finalize_freezes_report_and_archives_frames(db):
+    start_session(db, frames=4)
+    memory_session = {"last_activity": (START + timedelta(minutes=5)).isoformat(), "auth_failures": 2}
+
+    report = finalize_session_db(SESSION_ID, memory_session, db)
+
+    assert report["looking_away_percentage"] == 50.0
+    assert report["attention_score"] == 50.0
+    assert report["event_timeline"] == [
+        {
+            "timestamp": make_frame(i)["timestamp"],
+            "elapsed_seconds": 10.0 * i,
+            "suspicion_level": "critical",
+            "suspicious_behaviors": ["looking_away"],
+        }
+        for i in (1, 3)
+    ]
+    assert report["session_summary"]["end_time"] is not None
+
+    row = db.query(ExamSessionDB).filter_by(session_id=SESSION_ID).one()
+    assert row.end_time is not None
+    assert row.auth_failures == 2
+    assert row.last_activity >= START + timedelta(minutes=5)
+    assert row.detection_history == "[]"
+    assert row.cheating_events == "[]"
+
+    archive = db.query(SessionArchiveDB).filter_by(session_id=SESSION_ID).one()
+    assert len(session_store.unpack_records(archive.detection_history, session_store.DETECTION_SCHEMA)) == 4
+
+    frozen = db.query(SessionReportDB).filter_by(session_id=SESSION_ID).one()
+    assert json.loads(frozen.report) == report
+    # Ended sessions are served from the frozen report, not the cleared hot row
+    assert get_session_report(SESSION_ID, db) == report
+
+
+def test_finalize_is_idempotent(db):
+    start_session(db)
+    first = finalize_session_db(SESSION_ID, None, db)
+    second = finalize_session_db(SESSION_ID, None, db)
+    assert second == first
+    assert db.query(SessionReportDB).count() == 1
+    assert db.query(SessionArchiveDB).count() == 1
+
+
+def test_finalize_unknown_session(db):
+    assert finalize_session_db("missing", None, db) is None
+    assert get_session_report("missing", db) is None
+
+
+def test_frames_for_ended_session_are_rejected(db):
+    start_session(db, frames=4)
+    report = finalize_session_db(SESSION_ID, None, db)
+
+    assert save_frame_result(SESSION_ID, make_frame(9, looking_away=True), db) is False
+
+    row = db.query(ExamSessionDB).filter_by(session_id=SESSION_ID).one()
+    assert row.frame_count == report["session_summary"]["total_frames"] == 4
+    assert row.looking_away_count == 2
+    assert row.detection_history == "[]"
+    assert load_session_from_db(SESSION_ID, db)["end_time"] is not None
+
+
+def test_concurrent_finalize_keeps_first_report(tmp_path, monkeypatch):
+    make_session = make_sessionmaker(f"sqlite:///{tmp_path / 'sessions.db'}")
+    db = make_session()
+    start_session(db)
+
+    build_final_report = session_store.build_final_report
+    winner = {"session_summary": {"user_id": "user1"}, "winner": True}
+
+    def build_while_another_request_finalizes(db_session):
+        # Another request commits its report between our check and our insert
+        other = make_session()
+        other.add(SessionReportDB(session_id=SESSION_ID, user_id="user1", report=json.dumps(winner)))
+        other.commit()
+        other.close()
+        return build_final_report(db_session)
+
+    monkeypatch.setattr(session_store, "build_final_report", build_while_another_request_finalizes)
+
+    assert finalize_session_db(SESSION_ID, None, db) == winner
+    # The losing request rolled back: nothing archived, hot row untouched
+    assert db.query(SessionArchiveDB).count() == 0
+    assert db.query(ExamSessionDB).filter_by(session_id=SESSION_ID).one().end_time is None
+    db.close()
@@ -23,10 +23,22 @@ import uuid
 # import os
 
 # ============ DATABASE IMPORTS ============
-from sqlalchemy import create_engine, Column, String, Integer, Text, DateTime, Float, Boolean
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
 
+from history_codec import DETECTION_SCHEMA, CHEATING_EVENT_SCHEMA, unpack_records
+from session_store import (
+    Base,
+    ExamSessionDB,
+    SessionArchiveDB,
+    finalize_session_db,
+    get_or_create_session_db,
+    get_session_report,
+    load_session_from_db,
+    save_frame_result,
+)
+from embedding_index import SharedEmbeddingIndex, normalize_embeddings
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("anti_cheat_api")
@@ -48,31 +60,6 @@ engine = create_engine(
 )
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-# ============ DATABASE MODELS ============
-class ExamSessionDB(Base):
-    __tablename__ = "exam_sessions"
-    
-    session_id = Column(String(50), primary_key=True)
-    user_id = Column(String(100), nullable=False, index=True)
-    start_time = Column(DateTime, default=datetime.now)
-    last_activity = Column(DateTime, default=datetime.now)
-    end_time = Column(DateTime, nullable=True)
-    
-    # Session state
-    frame_count = Column(Integer, default=0)
-    warnings_issued = Column(Integer, default=0)
-    looking_away_count = Column(Integer, default=0)
-    auth_failures = Column(Integer, default=0)
-    
-    # Detection data (stored as JSON)
-    cheating_events = Column(Text, default="[]")
-    detection_history = Column(Text, default="[]")
-    
-    # Reference data
-    reference_image_hash = Column(String(255), nullable=True)
-    baseline_established = Column(Boolean, default=False)
 
 def get_db():
     db = SessionLocal()
@@ -98,12 +85,23 @@ MAX_IMAGE_DIMENSION = 480
 VERIFICATION_FREQUENCY = 10
 RANDOM_CHECK_PROBABILITY = 0.2
 SMOOTHING_WINDOW = 5
+FACENET_EMBEDDING_DIM = 128
+# Facenet's cosine distance threshold is 0.40, i.e. similarity >= 0.60
+IMPERSONATION_SIMILARITY_THRESHOLD = 0.6
+EMBEDDING_INDEX_DIR = os.getenv(
+    "EMBEDDING_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "embedding_index")
+)
 
 # Global state (in-memory cache for current session)
 user_sessions = {}
 exam_sessions = {}
 reference_images = {}
 
+# Reference embeddings for every registered user, shared across sessions and
+# kept in sync with the other API/worker processes through EMBEDDING_INDEX_DIR
+embedding_index = SharedEmbeddingIndex(EMBEDDING_INDEX_DIR, FACENET_EMBEDDING_DIM)
+
 # MediaPipe setup
 mp_face_detection = mp.solutions.face_detection
 mp_face_mesh = mp.solutions.face_mesh
@@ -158,138 +156,6 @@ class CheatingDetectionResult(BaseModel):
     attention_score: Optional[float]
     integrity_hash: str
 
-# ============ DATABASE FUNCTIONS ============
-def get_or_create_session_db(session_id: str, user_id: str, db: Session):
-    """Get existing session from DB or create new one"""
-    db_session = db.query(ExamSessionDB).filter(
-        ExamSessionDB.session_id == session_id
-    ).first()
-    
-    if not db_session:
-        db_session = ExamSessionDB(
-            session_id=session_id,
-            user_id=user_id,
-            start_time=datetime.now(),
-            last_activity=datetime.now()
-        )
-        db.add(db_session)
-        db.commit()
-        db.refresh(db_session)
-        logger.info(f"Created new session in DB: {session_id}")
-    
-    return db_session
-
-def save_frame_result(session_id: str, detection_result: dict, db: Session):
-    """Save individual frame detection result to database"""
-    try:
-        db_session = db.query(ExamSessionDB).filter(
-            ExamSessionDB.session_id == session_id
-        ).first()
-        
-        if db_session:
-            # Update frame count and last activity
-            db_session.frame_count += 1
-            db_session.last_activity = datetime.now()
-            
-            # Append to detection history (keep last 100)
-            history = json.loads(db_session.detection_history)
-            history.append(detection_result)
-            if len(history) > 100:
-                history = history[-100:]
-            db_session.detection_history = json.dumps(history)
-            
-            # Update cheating events if suspicious
-            if detection_result.get('suspicion_level') in ['high', 'critical']:
-                events = json.loads(db_session.cheating_events)
-                events.append({
-                    'timestamp': detection_result['timestamp'],
-                    'suspicion_level': detection_result['suspicion_level'],
-                    'cheating_probability': detection_result['cheating_probability'],
-                    'suspicious_behaviors': detection_result.get('suspicious_behaviors', [])
-                })
-                db_session.cheating_events = json.dumps(events)
-            
-            # Update looking away count
-            if detection_result.get('looking_away'):
-                db_session.looking_away_count += 1
-            
-            # Update warnings
-            if len(detection_result.get('warnings', [])) > 0:
-                db_session.warnings_issued += 1
-            
-            db.commit()
-            logger.info(f"Saved frame result for session {session_id}")
-    except Exception as e:
-        logger.error(f"Error saving frame result: {str(e)}")
-        db.rollback()
-
-def load_session_from_db(session_id: str, db: Session) -> Optional[dict]:
-    """Load session state from database"""
-    try:
-        db_session = db.query(ExamSessionDB).filter(
-            ExamSessionDB.session_id == session_id
-        ).first()
-        
-        if not db_session:
-            return None
-        
-        return {
-            'session_id': db_session.session_id,
-            'user_id': db_session.user_id,
-            'start_time': db_session.start_time.isoformat(),
-            'last_activity': db_session.last_activity.isoformat(),
-            'frame_count': db_session.frame_count,
-            'warnings_issued': db_session.warnings_issued,
-            'looking_away_count': db_session.looking_away_count,
-            'auth_failures': db_session.auth_failures,
-            'cheating_events': json.loads(db_session.cheating_events),
-            'detection_history': json.loads(db_session.detection_history),
-        }
-    except Exception as e:
-        logger.error(f"Error loading session from DB: {str(e)}")
-        return None
-
-def get_session_report(session_id: str, db: Session) -> Optional[dict]:
-    """Get full session report for analysis"""
-    try:
-        db_session = db.query(ExamSessionDB).filter(
-            ExamSessionDB.session_id == session_id
-        ).first()
-        
-        if not db_session:
-            return None
-        
-        cheating_events = json.loads(db_session.cheating_events)
-        detection_history = json.loads(db_session.detection_history)
-        
-        duration = (db_session.last_activity - db_session.start_time).total_seconds()
-        
-        return {
-            'session_summary': {
-                'session_id': db_session.session_id,
-                'user_id': db_session.user_id,
-                'session_duration': duration,
-                'total_frames': db_session.frame_count,
-                'warnings_issued': db_session.warnings_issued,
-                'looking_away_count': db_session.looking_away_count,
-                'start_time': db_session.start_time.isoformat(),
-                'last_activity': db_session.last_activity.isoformat(),
-            },
-            'cheating_events': cheating_events,
-            'suspicious_behaviors': list(set(
-                b for h in detection_history 
-                for b in h.get('suspicious_behaviors', [])
-            )),
-            'average_suspicion': sum(
-                h.get('cheating_probability', 0) 
-                for h in detection_history
-            ) / len(detection_history) if detection_history else 0,
-            'total_cheating_events': len(cheating_events)
-        }
-    except Exception as e:
-        logger.error(f"Error getting session report: {str(e)}")
-        return None
-
 # ============ HELPER FUNCTIONS ============
 def generate_session_id():
     return str(uuid.uuid4()).upper()[:12]
@@ -331,6 +197,88 @@ def verify_identity(reference_img, current_img):
         logger.error(f"Error in verify_identity: {str(e)}")
         return {"verified": False, "distance": 1.0, "threshold": 0.4}
 
+def compute_face_embedding(img, require_face: bool = False) -> Optional[np.ndarray]:
+    """Facenet embedding of the first face in img.
+
+    With require_face, returns None when the detector found no face instead
+    of embedding the whole image.
+    """
+    try:
+        representations = DeepFace.represent(
+            img,
+            model_name="Facenet",
+            enforce_detection=False,
+            detector_backend="opencv"
+        )
+        if not representations:
+            return None
+        representation = representations[0]
+        if require_face and not face_was_detected(representation, img.shape):
+            return None
+        return np.asarray(representation["embedding"], dtype=np.float32)
+    except Exception as e:
+        logger.error(f"Error in compute_face_embedding: {str(e)}")
+        return None
+
+def face_was_detected(representation: Dict[str, Any], image_shape) -> bool:
+    # With enforce_detection=False DeepFace falls back to the whole image,
+    # reporting zero confidence and a facial area covering the full frame
+    if "face_confidence" in representation:
+        return representation["face_confidence"] > 0
+    area = representation.get("facial_area") or {}
+    h, w = image_shape[:2]
+    return not (area.get("x", 0) == 0 and area.get("y", 0) == 0
+                and area.get("w", w) >= w and area.get("h", h) >= h)
+
+def reference_embedding_for(reference_img, cache: Optional[Dict[str, Any]] = None) -> Optional[np.ndarray]:
+    """Embedding of a session's reference image, computed once per image.
+
+    cache is any dict that lives as long as the session; the embedding is
+    recomputed when the reference image object is replaced.
+    """
+    if cache is None:
+        return compute_face_embedding(reference_img)
+    if cache.get("reference_image") is not reference_img:
+        cache["reference_image"] = reference_img
+        cache["reference_embedding"] = compute_face_embedding(reference_img)
+    return cache["reference_embedding"]
+
+def verify_against_index(img, user_id: str, reference_embedding: Optional[np.ndarray] = None):
+    """Verify a frame with one embedding, also searching other registered candidates.
+
+    The user's own identity is checked against reference_embedding when the
+    session has a reference image, otherwise against the user's row in the
+    index. Returns a verify_identity()-style result plus "other_candidate":
+    the (user_id, similarity) of a different registered candidate the face
+    matches better than the user's own reference, or None.
+    """
+    result = {
+        "verified": False,
+        "distance": 1.0,
+        "threshold": 1 - IMPERSONATION_SIMILARITY_THRESHOLD,
+        "other_candidate": None,
+    }
+    embedding = compute_face_embedding(img)
+    if embedding is None:
+        return result
+
+    if reference_embedding is not None:
+        own_similarity = float(
+            normalize_embeddings(embedding)[0] @ normalize_embeddings(reference_embedding)[0]
+        )
+    else:
+        own_similarity = embedding_index.score(user_id, embedding)
+    result["distance"] = 1 - own_similarity
+    result["verified"] = own_similarity >= IMPERSONATION_SIMILARITY_THRESHOLD
+
+    for other_user_id, similarity in embedding_index.search(embedding, k=2)[0]:
+        if other_user_id == user_id:
+            continue
+        if similarity >= IMPERSONATION_SIMILARITY_THRESHOLD and similarity > own_similarity:
+            result["other_candidate"] = (other_user_id, similarity)
+        break
+    return result
+
 def analyze_gaze(landmarks):
     left_eye = landmarks[33]
     right_eye = landmarks[263]
@@ -380,7 +328,8 @@ def analyze_frame_optimized(
     session_history: deque,
     context_data: Dict[str, Any],
     random_check: bool,
-    frame_count: int
+    frame_count: int,
+    reference_cache: Optional[Dict[str, Any]] = None
 ):
     result = CheatingDetectionResult(
         session_id=session_id,
@@ -432,11 +381,20 @@ def analyze_frame_optimized(
                 result.suspicion_level = SuspicionLevel.CRITICAL
                 result.cheating_probability = 0.9
 
-        should_verify = reference_img is not None and (
-            random_check or (frame_count % VERIFICATION_FREQUENCY == 0)
-        )
-        if should_verify:
-            verification_result = verify_identity(reference_img, img)
+        should_verify = random_check or (frame_count % VERIFICATION_FREQUENCY == 0)
+        verification_result = None
+        if should_verify and reference_img is not None:
+            # The session's own reference takes precedence over the registered face;
+            # a single Facenet pass on the frame serves both checks
+            reference_embedding = reference_embedding_for(reference_img, reference_cache)
+            if reference_embedding is not None:
+                verification_result = verify_against_index(img, user_id, reference_embedding)
+            else:
+                verification_result = verify_identity(reference_img, img)
+        elif should_verify and user_id in embedding_index:
+            verification_result = verify_against_index(img, user_id)
+
+        if verification_result:
             if not verification_result["verified"]:
                 result.suspicious_behaviors.append("identity_mismatch")
                 result.cheating_indicators.append(CheatingIndicator(
@@ -448,6 +406,24 @@ def analyze_frame_optimized(
                 result.suspicion_level = SuspicionLevel.CRITICAL
                 result.cheating_probability = min(verification_result["distance"], 0.9)
 
+            other_candidate = verification_result.get("other_candidate")
+            if other_candidate and result.faces_detected > 0:
+                other_user_id, similarity = other_candidate
+                # The matched candidate's ID stays server-side; results reach the browser
+                logger.warning(
+                    f"Session {session_id}: face of user {user_id} matches registered "
+                    f"candidate {other_user_id} (similarity {similarity:.3f})"
+                )
+                result.suspicious_behaviors.append("matches_other_candidate")
+                result.cheating_indicators.append(CheatingIndicator(
+                    indicator_type="impersonation",
+                    confidence=similarity,
+                    description="Face matches a different registered candidate"
+                ))
+                result.warnings.append("Face matches a different registered candidate")
+                result.suspicion_level = SuspicionLevel.CRITICAL
+                result.cheating_probability = max(result.cheating_probability, 0.9)
+
         face_mesh_result = analyze_face_mesh(img)
         if face_mesh_result["gaze_metrics"]:
             result.gaze_metrics = face_mesh_result["gaze_metrics"]
@@ -494,14 +470,24 @@ async def register_face(
     try:
         contents = await image.read()
         img_hash = calculate_hash(contents)
+
+        img = preprocess_image(contents)
+        if img is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid image format")
+        embedding = compute_face_embedding(img, require_face=True)
+        if embedding is None:
+            logger.warning(f"No face detected in reference image for user {user_id}")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="No face detected in reference image"
+            )
+
         reference_images[user_id] = contents
-        
         for session_id, session in user_sessions.items():
             if session["user_id"] == user_id:
-                img = preprocess_image(contents)
-                if img is not None:
-                    session["reference_image"] = img
+                session["reference_image"] = img
                 session["auth_failures"] = 0
+        embedding_index.add(user_id, embedding)
         
         logger.info(f"Reference face registered for user {user_id}")
         return {
@@ -509,10 +495,28 @@ async def register_face(
             "user_id": user_id,
             "image_hash": img_hash
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in register_face: {str(e)}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
+@app.post("/unregister-face/")
+async def unregister_face(user_id: str = Form(...)):
+    try:
+        reference_images.pop(user_id, None)
+        removed = embedding_index.remove(user_id)
+        
+        logger.info(f"Reference face unregistered for user {user_id}")
+        return {
+            "status": "success",
+            "user_id": user_id,
+            "removed": removed
+        }
+    except Exception as e:
+        logger.error(f"Error in unregister_face: {str(e)}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
 @app.post("/start-exam-session/")
 async def start_exam_session(
     user_id: str = Form(...),
@@ -594,7 +598,13 @@ async def detect_cheating(
                     status_code=status.HTTP_404_NOT_FOUND,
                     detail="Invalid session ID. Please start a new exam session."
                 )
-            
+            if db_session_data['end_time']:
+                logger.error(f"Session ID {session_id} has already ended")
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail="Exam session has ended. Please start a new exam session."
+                )
+
             # Reconstruct session in memory from database
             user_sessions[session_id] = {
                 "user_id": db_session_data['user_id'],
@@ -653,7 +663,8 @@ async def detect_cheating(
             session_history=session["history"],
             context_data=context_data,
             random_check=random_check,
-            frame_count=session["frame_count"]
+            frame_count=session["frame_count"],
+            reference_cache=session.setdefault("reference_cache", {})
         )
 
         result.integrity_hash = frame_hash
@@ -683,8 +694,14 @@ async def detect_cheating(
             if len(clean_result["suspicious_behaviors"]) > 0:
                 session["warnings_issued"] += 1
 
-        # Save to database
-        save_frame_result(session_id, clean_result, db)
+        # Save to database; another process may have ended the session
+        if not save_frame_result(session_id, clean_result, db):
+            user_sessions.pop(session_id, None)
+            exam_sessions.pop(session_id, None)
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Exam session has ended. Please start a new exam session."
+            )
         
         logger.info(f"Successfully processed detect-cheating for session {session_id}")
         return clean_result
@@ -700,6 +717,38 @@ async def detect_cheating(
             detail=f"Error processing image: {str(e)}"
         )
 
+@app.post("/end-exam-session/")
+async def end_exam_session(
+    session_id: str = Form(...),
+    db: Session = Depends(get_db)
+):
+    try:
+        memory_session = user_sessions.get(session_id)
+        report = finalize_session_db(session_id, memory_session, db)
+        if report is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Session not found"
+            )
+
+        # Evict in-memory state; the user's registration stays until /unregister-face/
+        user_sessions.pop(session_id, None)
+        exam_sessions.pop(session_id, None)
+        user_id = report["session_summary"]["user_id"]
+
+        logger.info(f"Ended exam session {session_id} for user {user_id}")
+        return {
+            "status": "success",
+            "session_id": session_id,
+            "end_time": report["session_summary"]["end_time"],
+            "report": report
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in end_exam_session: {str(e)}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
 @app.get("/get-session-report/{session_id}")
 async def get_session_report_endpoint(session_id: str, db: Session = Depends(get_db)):
     """Get full session report"""
@@ -711,6 +760,31 @@ async def get_session_report_endpoint(session_id: str, db: Session = Depends(get
         )
     return report
 
+@app.get("/export-session-history/{session_id}")
+async def export_session_history(session_id: str, db: Session = Depends(get_db)):
+    """Export stored detection history and cheating events as plain JSON"""
+    archive = db.query(SessionArchiveDB).filter(
+        SessionArchiveDB.session_id == session_id
+    ).first()
+    if archive:
+        return {
+            "session_id": session_id,
+            "detection_history": unpack_records(archive.detection_history, DETECTION_SCHEMA),
+            "cheating_events": unpack_records(archive.cheating_events, CHEATING_EVENT_SCHEMA),
+        }
+
+    session_data = load_session_from_db(session_id, db)
+    if not session_data:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Session not found"
+        )
+    return {
+        "session_id": session_id,
+        "detection_history": session_data["detection_history"],
+        "cheating_events": session_data["cheating_events"],
+    }
+
 @app.get("/get_behavior_data")
 async def get_behavior_data(session_id: Optional[str] = None, db: Session = Depends(get_db)):
     """Get behavior data for all sessions or specific session"""